@@ -25,6 +25,7 @@
 
 #---------------------------------------------------------------------------
 
+import hashlib
 import struct
 from six     import string_types, text_type
 from locale  import getpreferredencoding
@@ -43,11 +44,47 @@ class NatlinkCompiler(CompilerBase):
 
     def compile_grammar(self, grammar):
         self._log.debug("%s: Compiling grammar %s." % (self, grammar.name))
-
-        compiler = _Compiler()
+        recording = self.record_grammar(grammar)
+        return self.compile_recording(recording)
+
+    def record_grammar(self, grammar, rule_cache=None):
+        """
+            Record the internal compiler calls needed to compile the given
+            *grammar*, without building the binary grammar.
+
+            The returned recording can be compiled using
+            :meth:`compile_recording`.  Its ``digest`` attribute identifies
+            the structure of the grammar and may be used as a cache key.
+
+            If the optional *rule_cache* mapping is given, the recorded
+            calls of each rule are stored in it, keyed by rule object, and
+            reused for rules seen before.  This way, rules shared between
+            grammars are only walked once.  This relies on rule objects
+            not changing after construction; a rule's name, element and
+            exported/imported flags are all read-only.
+        """
+        recorder = _CompilerRecorder()
         for rule in grammar.rules:
-            self._compile_rule(rule, compiler)
+            if rule_cache is None:
+                self._compile_rule(rule, recorder)
+                continue
 
+            calls = rule_cache.get(rule)
+            if calls is None:
+                rule_recorder = _CompilerRecorder()
+                self._compile_rule(rule, rule_recorder)
+                calls = tuple(rule_recorder.calls)
+                rule_cache[rule] = calls
+            recorder.extend(calls)
+        return recorder
+
+    def compile_recording(self, recording):
+        """
+            Compile a recording returned by :meth:`record_grammar` into a
+            ``(compiled_grammar, rule_names)`` 2-tuple.
+        """
+        compiler = _Compiler()
+        recording.replay(compiler)
         compiled_grammar = compiler.compile()
         rule_names = compiler.rule_names
 #        print compiler.debug_state_string()
@@ -125,6 +162,66 @@ class NatlinkCompiler(CompilerBase):
         pass
 
 
+#===========================================================================
+# Internal class which records calls made to the _Compiler class below so
+#  that they can be hashed and replayed later.
+
+def _new_hash():
+    try:
+        return hashlib.blake2b(digest_size=16)
+    except AttributeError:
+        # hashlib.blake2b() is not available on Python 2.
+        return hashlib.sha1()
+
+
+class _CompilerRecorder(object):
+
+    def __init__(self):
+        self.calls = []
+        self._digest = None
+
+    def _record(name):  # pylint: disable=no-self-argument
+        def method(self, *args, **kwargs):
+            self.calls.append((name, args, tuple(sorted(kwargs.items()))))
+            self._digest = None
+        method.__name__ = name
+        return method
+
+    start_rule_definition = _record("start_rule_definition")
+    end_rule_definition   = _record("end_rule_definition")
+    start_sequence        = _record("start_sequence")
+    end_sequence          = _record("end_sequence")
+    start_alternative     = _record("start_alternative")
+    end_alternative       = _record("end_alternative")
+    start_repetition      = _record("start_repetition")
+    end_repetition        = _record("end_repetition")
+    start_optional        = _record("start_optional")
+    end_optional          = _record("end_optional")
+    add_word              = _record("add_word")
+    add_list              = _record("add_list")
+    add_rule              = _record("add_rule")
+    del _record
+
+    def extend(self, calls):
+        """Append previously recorded calls."""
+        self.calls.extend(calls)
+        self._digest = None
+
+    def replay(self, compiler):
+        """Replay the recorded calls on the given compiler."""
+        for name, args, kwargs in self.calls:
+            getattr(compiler, name)(*args, **dict(kwargs))
+
+    @property
+    def digest(self):
+        """Hex digest of the recorded calls."""
+        if self._digest is None:
+            h = _new_hash()
+            h.update(repr(self.calls).encode("utf-8"))
+            self._digest = h.hexdigest()
+        return self._digest
+
+
 #===========================================================================
 # Internal compiler class which takes care of the binary format
 #  used to specify grammars with Dragon NaturallySpeaking.
@@ -29,12 +29,14 @@ Detecting sleep mode
 
 """
 
+import logging
 import os
 import os.path
 import pywintypes
+import struct
 import sys
 import time
-from datetime   import datetime
+import weakref
 from locale     import getpreferredencoding
 from threading  import Thread, Event
 
@@ -53,7 +55,48 @@ from dragonfly.engines.backend_natlink.timer      import NatlinkTimerManager
 
 # ---------------------------------------------------------------------------
 
-def map_word(word, encoding=getpreferredencoding(do_setlocale=False)):
+# The encoding assumed for byte strings sent to and received from Dragon.
+_ENCODING = getpreferredencoding(do_setlocale=False)
+
+# Format of retained audio data from Dragon: 11025Hz 16bit mono PCM.
+_WAV_RATE = 11025
+_WAV_BYTES_PER_SAMPLE = 2
+
+# RIFF header for .wav files of retained audio data.
+_WAV_HEADER = struct.Struct("<4sI4s4sIHHIIHH4sI")
+
+
+def _build_wav_header(data_size):
+    return _WAV_HEADER.pack(
+        b"RIFF", 36 + data_size, b"WAVE",
+        b"fmt ", 16, 1, 1, _WAV_RATE,           # PCM, mono
+        _WAV_RATE * _WAV_BYTES_PER_SAMPLE,      # byte rate
+        _WAV_BYTES_PER_SAMPLE,                  # block align
+        _WAV_BYTES_PER_SAMPLE * 8,              # bits per sample
+        b"data", data_size
+    )
+
+
+# Cached (seconds, formatted string) pair for _retain_timestamp().
+_retain_timestamp_cache = (None, None)
+
+
+def _retain_timestamp():
+    # Return the current local time formatted for retained audio file
+    #  names.  The strftime() result is only recomputed when the second
+    #  changes.
+    global _retain_timestamp_cache
+    now = time.time()
+    seconds = int(now)
+    cached_seconds, formatted = _retain_timestamp_cache
+    if seconds != cached_seconds:
+        formatted = time.strftime("%Y-%m-%d_%H-%M-%S",
+                                  time.localtime(seconds))
+        _retain_timestamp_cache = (seconds, formatted)
+    return "%s_%06d" % (formatted, int((now - seconds) * 1000000))
+
+
+def map_word(word, encoding=_ENCODING):
     """
     Wraps output from Dragon.
 
@@ -98,8 +141,8 @@ class TimerThread(Thread):
         self._stop_timer()
 
     def run(self):
-        while not self._stop_event.is_set():
-            time.sleep(1)
+        # Block until stop() is called.
+        self._stop_event.wait()
         self._stop_timer()
 
 
@@ -137,11 +180,17 @@ class NatlinkEngine(EngineBase):
         self.natlink = natlink
 
         self._grammar_count = 0
+        self._compiled_grammars = {}
+        self._rule_recordings = weakref.WeakKeyDictionary()
         self._recognition_observer_manager = NatlinkRecObsManager(self)
         self._timer_manager = NatlinkTimerManager(0.02, self)
         self._timer_thread = None
         self._retain_dir = None
+        self._retain_dir_valid = False
+        self._retain_tsv_fh = None
+        self._retain_tsv_dir = None
         self._speaker = NatlinkSpeaker()
+        self._dgn_app = None
         try:
             self.set_retain_directory(retain_dir)
         except EngineError as err:
@@ -156,7 +205,17 @@ class NatlinkEngine(EngineBase):
 
         This method is called automatically when :meth:`connect` is called
         or when a grammar is loaded for the first time.
+
+        The fix is not necessary, and is therefore not applied, if the GIL
+        is disabled.  This is only possible with free-threaded builds of
+        Python 3.13 and above.
         """
+        # Check whether the GIL is disabled.  This is done here because
+        #  importing an extension module can re-enable the GIL at runtime.
+        is_gil_enabled = getattr(sys, "_is_gil_enabled", None)
+        if is_gil_enabled is not None and not is_gil_enabled():
+            return
+
         # Start a thread and engine timer to allow Python threads to work
         # properly while connected to Natlink.
         # Only start the thread if one isn't already active.
@@ -180,8 +239,9 @@ class NatlinkEngine(EngineBase):
         # process.
         from dragonfly import Window
         target_title = "Natlink / Python Subsystem"
+        pid = os.getpid()
         for window in Window.get_matching_windows(title=target_title):
-            if window.is_visible and window.pid == os.getpid():
+            if window.is_visible and window.pid == pid:
                 try:
                     window.close()
                 except pywintypes.error:
@@ -193,6 +253,12 @@ class NatlinkEngine(EngineBase):
             self._timer_thread.stop()
             self._timer_thread = None
 
+        # Close the retain.tsv file, if it is open.
+        self._close_tsv_handle()
+
+        # Release the Dragon COM object, if it was created.
+        self._dgn_app = None
+
         # Finally disconnect from natlink.
         self.natlink.natDisconnect()
 
@@ -210,12 +276,16 @@ class NatlinkEngine(EngineBase):
         grammar_object.setResultsCallback(wrapper.results_callback)
         grammar_object.setHypothesisCallback(None)
 
-        c = NatlinkCompiler()
-        (compiled_grammar, rule_names) = c.compile_grammar(grammar)
+        # Note: rule_names is a tuple indexed by the rule IDs in
+        #  recognition results; see State.rule().
+        (compiled_grammar, rule_names) = self._compile_grammar(grammar)
         wrapper.rule_names = rule_names
 
-        all_results = (hasattr(grammar, "process_recognition_other")
-                       or hasattr(grammar, "process_recognition_failure"))
+        all_results = (
+            getattr(grammar, "process_recognition_other", None) is not None
+            or getattr(grammar, "process_recognition_failure", None)
+            is not None
+        )
         hypothesis = False
 
         attempt_connect = False
@@ -252,6 +322,23 @@ class NatlinkEngine(EngineBase):
         # Return the grammar wrapper.
         return wrapper
 
+    def _compile_grammar(self, grammar):
+        # Compile the grammar, reusing the previous compiled grammar of the
+        #  same name if its structure hasn't changed since.  Recorded rule
+        #  definitions are shared between grammars.
+        c = NatlinkCompiler()
+        recording = c.record_grammar(grammar, self._rule_recordings)
+        digest = recording.digest
+        cached = self._compiled_grammars.get(grammar.name)
+        if cached is not None and cached[0] == digest:
+            self._log.debug("Engine %s: using cached compilation of "
+                            "grammar %s." % (self, grammar.name))
+            return cached[1]
+
+        result = c.compile_recording(recording)
+        self._compiled_grammars[grammar.name] = (digest, result)
+        return result
+
     def _unload_grammar(self, grammar, wrapper):
         """ Unload the given *grammar* from natlink. """
         try:
@@ -301,13 +388,20 @@ class NatlinkEngine(EngineBase):
         #  n and f as an optimization.
         n = lst.name
         f = grammar_object.appendList
+        items = lst.get_list_items()
         grammar_object.emptyList(n)
-        [f(n, word) for word in lst.get_list_items()]
+        for word in items:
+            f(n, word)
 
     #-----------------------------------------------------------------------
     # Miscellaneous methods.
 
     def _do_recognition(self):
+        # Note: waitForSpeech() must be called from the thread that called
+        #  natConnect(), since Natlink's callbacks are dispatched by that
+        #  thread's message loop.  Handing the call off to another thread
+        #  would not release the GIL either; other Python threads are
+        #  serviced by the TimerThread instead.
         self.natlink.waitForSpeech()
 
     def mimic(self, words):
@@ -330,10 +424,9 @@ class NatlinkEngine(EngineBase):
         try:
             prepared_words = []
             if PY2:
-                encoding = getpreferredencoding()
                 for word in words:
                     if isinstance(word, text_type):
-                        word = word.encode(encoding)
+                        word = word.encode(_ENCODING)
                     prepared_words.append(word)
             else:
                 for word in words:
@@ -354,10 +447,14 @@ class NatlinkEngine(EngineBase):
         self._speaker.speak(text)
 
     def _get_language(self):
-        # Get a Windows language identifier from Dragon.
-        import win32com.client
-        app = win32com.client.Dispatch("Dragon.DgnEngineControl")
-        language = app.SpeakerLanguage("")
+        # Get a Windows language identifier from Dragon.  The COM object
+        #  is created once and reused.
+        if self._dgn_app is None:
+            import win32com.client
+            self._dgn_app = win32com.client.Dispatch(
+                "Dragon.DgnEngineControl"
+            )
+        language = self._dgn_app.SpeakerLanguage("")
 
         # Lookup and return the language tag.
         return self._get_language_tag(language)
@@ -403,8 +500,37 @@ class NatlinkEngine(EngineBase):
                     retain_dir
                 )
 
-        # Set the retain directory.
+        # Close the retain.tsv file of the previous directory, if any, so
+        #  that it isn't kept open (and locked) needlessly.
+        if retain_dir != self._retain_dir:
+            self._close_tsv_handle()
+
+        # Set the retain directory and let grammar wrappers know whether
+        #  audio should be retained.
         self._retain_dir = retain_dir
+        self._retain_dir_valid = (retain_dir is not None and
+                                  os.path.isdir(retain_dir))
+        for wrapper in self._grammar_wrappers.values():
+            wrapper._retain_enabled = bool(retain_dir)
+
+    def _get_tsv_handle(self, retain_dir):
+        # Return the open retain.tsv file for the given directory, opening
+        #  it in append mode if necessary.
+        if self._retain_tsv_fh is None or self._retain_tsv_dir != retain_dir:
+            self._close_tsv_handle()
+            tsv_path = os.path.join(retain_dir, "retain.tsv")
+            self._retain_tsv_fh = open(tsv_path, "a")
+            self._retain_tsv_dir = retain_dir
+        return self._retain_tsv_fh
+
+    def _close_tsv_handle(self):
+        if self._retain_tsv_fh is not None:
+            try:
+                self._retain_tsv_fh.close()
+            except (IOError, OSError) as err:
+                self._log.warning("Failed to close retain.tsv: %s", err)
+            self._retain_tsv_fh = None
+            self._retain_tsv_dir = None
 
 #---------------------------------------------------------------------------
 
@@ -422,11 +548,15 @@ class GrammarWrapper(GrammarWrapperBase):
         self.active_rules_set = set()
         self.hwnd = 0
         self.beginning = False
+        self._rule_hwnds = {}
+        self._retain_enabled = bool(engine._retain_dir)
 
     def begin_callback(self, module_info):
         self.beginning = True
-        executable, title, handle = tuple(map_word(word)
-                                          for word in module_info)
+        # The window handle is an integer and does not need to be mapped.
+        executable, title, handle = module_info
+        executable = map_word(executable)
+        title = map_word(title)
         self.hwnd = handle
 
         # Run the grammar's process_begin() method.
@@ -447,25 +577,36 @@ class GrammarWrapper(GrammarWrapperBase):
         # Rule activation is delayed.
         if self.beginning: return
 
+        # Do nothing if the rule is already active for the current window.
+        hwnd = self.hwnd
+        if self._rule_hwnds.get(rule_name) == hwnd:
+            return
+
         # Activate the rule for the current window.
         grammar_object = self.grammar_object
         try:
-            grammar_object.activate(rule_name, self.hwnd)
+            grammar_object.activate(rule_name, hwnd)
         except self.natlink.NatError:
             grammar_object.deactivate(rule_name)
-            grammar_object.activate(rule_name, self.hwnd)
+            grammar_object.activate(rule_name, hwnd)
+        self._rule_hwnds[rule_name] = hwnd
 
     def deactivate_rule(self, rule_name):
         self.active_rules_set.remove(rule_name)
+        self._rule_hwnds.pop(rule_name, None)
         grammar_object = self.grammar_object
         grammar_object.deactivate(rule_name)
 
     def results_callback(self, words, results):
-        self._log.debug("Grammar %s: received recognition %r.",
-                        self.grammar.name, words)
+        log = self._log
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Grammar %s: received recognition %r.",
+                      self.grammar.name, words)
 
+        # Use a local variable for map_word() as an optimization.
+        mw = map_word
         if words == "other":
-            result_words = tuple(map_word(w) for w in results.getWords(0))
+            result_words = tuple(mw(w) for w in results.getWords(0))
             self.recognition_other_callback(result_words, results)
             return
         elif words == "reject":
@@ -474,8 +615,12 @@ class GrammarWrapper(GrammarWrapperBase):
 
         # If the words argument was not "other" or "reject", then
         #  it is a sequence of (word, rule_id) 2-tuples.  Convert this
-        #  into a tuple of unicode objects.
-        words_rules = tuple((map_word(w), r) for w, r in words)
+        #  into a tuple of unicode objects, if necessary.  Natlink returns
+        #  words of the same type, so only the first one is checked.
+        if words and type(words[0][0]) is text_type:
+            words_rules = tuple(words)
+        else:
+            words_rules = tuple((mw(w), r) for w, r in words)
 
         # Process this recognition without dispatching results to other
         #  grammars; Natlink handles this for us perfectly.
@@ -485,13 +630,14 @@ class GrammarWrapper(GrammarWrapperBase):
 
         # Failed to decode recognition.
         words = tuple(w for w, r in words_rules)
-        self._log.error("Grammar %s: failed to decode recognition %r.",
-                        self.grammar._name, words)
+        log.error("Grammar %s: failed to decode recognition %r.",
+                  self.grammar._name, words)
 
     def _process_final_rule(self, state, words, results, dispatch_other,
                             rule, *args):
         # Retain audio, if appropriate.
-        self._retain_audio(words, results, rule.name)
+        if self._retain_enabled:
+            self._retain_audio(words, results, rule.name)
 
         # Call the base class method.
         GrammarWrapperBase._process_final_rule(self, state, words, results,
@@ -501,10 +647,14 @@ class GrammarWrapper(GrammarWrapperBase):
     #  A grammar with a `process_recognition_other' function should be able
     #  to handle this without issue.
     def _retain_audio(self, words, results, rule_name):
-        # Only write audio data and metadata if the directory exists.
-        retain_dir = self.engine._retain_dir
-        if retain_dir and not os.path.isdir(retain_dir):
-            self.engine._log.warning(
+        # Only write audio data and metadata if the directory exists.  The
+        #  result of the last check is cached; check again if it failed.
+        engine = self.engine
+        retain_dir = engine._retain_dir
+        if retain_dir and not engine._retain_dir_valid:
+            engine._retain_dir_valid = os.path.isdir(retain_dir)
+        if retain_dir and not engine._retain_dir_valid:
+            engine._log.warning(
                 "Audio was not retained because '%s' was not a "
                 "directory" % retain_dir
             )
@@ -513,22 +663,27 @@ class GrammarWrapper(GrammarWrapperBase):
                 audio = results.getWave()
                 # Make sure we have audio data
                 if len(audio) > 0:
-                    # Write audio data.
-                    now = datetime.now()
-                    filename = ("retain_%s.wav"
-                                % now.strftime("%Y-%m-%d_%H-%M-%S_%f"))
+                    # Write audio data with a RIFF header.
+                    filename = "retain_%s.wav" % _retain_timestamp()
                     wav_path = os.path.join(retain_dir, filename)
                     with open(wav_path, "wb") as f:
-                        f.write(audio)
+                        f.write(_build_wav_header(len(audio)) + audio)
 
-                    # Write metadata, assuming 11025Hz 16bit mono audio
+                    # Write metadata.
                     text = ' '.join(words)
-                    audio_length = float(len(audio) / 2) / 11025
-                    tsv_path = os.path.join(retain_dir, "retain.tsv")
-                    with open(tsv_path, "a") as tsv_file:
-                        tsv_file.write('\t'.join([
-                            filename, text_type(audio_length),
-                            self.grammar.name, rule_name, text
-                        ]) + '\n')
+                    audio_length = (float(len(audio)) / _WAV_BYTES_PER_SAMPLE
+                                    / _WAV_RATE)
+                    tsv_file = engine._get_tsv_handle(retain_dir)
+                    tsv_file.write('\t'.join([
+                        filename, text_type(audio_length),
+                        self.grammar.name, rule_name, text
+                    ]) + '\n')
+                    tsv_file.flush()
             except:
                 self._log.exception("Exception retaining audio")
+
+                # Check the directory again and close retain.tsv if the
+                #  directory is gone.
+                engine._retain_dir_valid = os.path.isdir(retain_dir)
+                if not engine._retain_dir_valid:
+                    engine._close_tsv_handle()
@@ -187,10 +187,9 @@ class EngineBase(object):
         self.set_exclusiveness(grammar, exclusive)
 
     def _get_grammar_wrapper(self, grammar):
-        wrapper_key = id(grammar)
-        if wrapper_key not in self._grammar_wrappers:
+        wrapper = self._grammar_wrappers.get(id(grammar))
+        if wrapper is None:
             raise EngineError("Grammar %s never loaded." % grammar)
-        wrapper = self._grammar_wrappers[wrapper_key]
         return wrapper
 
     #-----------------------------------------------------------------------
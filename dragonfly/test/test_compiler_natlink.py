@@ -49,5 +49,45 @@ class TestCompilerNatlink(unittest.TestCase):
         else:
             assert codecs.encode(compiled_grammar, "hex_codec") == b"0000000000000000040000001c0000001c000000010000004578616d706c65437573746f6d52756c650000000500000000000000060000000000000002000000900000000c0000000100000049000000100000000200000077616e74000000000c00000003000000746f00000c00000004000000656174000c00000005000000616e00000c000000060000006100000010000000070000006a7569637900000010000000080000006170706c6500000010000000090000006772656173790000140000000a00000068616d62757267657200000003000000e0000000e00000000100000001000000010000000100000001000000030000000100000003000000020000000300000003000000030000000400000002000000010000000100000002000000010000000100000001000000020000000300000005000000010000000100000003000000060000000300000007000000020000000100000002000000020000000300000008000000020000000100000001000000010000000300000006000000010000000400000003000000090000000200000004000000030000000a000000020000000100000002000000020000000200000001000000"
 
+    def test_natlink_compiler_recording(self):
+        from dragonfly.engines.backend_natlink.compiler import NatlinkCompiler
+        def build_grammar(spec):
+            grammar = Grammar(name="mygrammar")
+            grammar.add_rule(CompoundRule("ExampleRule", spec))
+            return grammar
+
+        c = NatlinkCompiler()
+        grammar = build_grammar("I want to eat [an] apple")
+        recording = c.record_grammar(grammar)
+
+        # Compiling a recording should give the same result as compiling
+        #  the grammar directly.
+        assert c.compile_recording(recording) == c.compile_grammar(grammar)
+
+        # Recordings of structurally identical grammars should have the
+        #  same digest.
+        other = c.record_grammar(build_grammar("I want to eat [an] apple"))
+        assert recording.digest == other.digest
+        other = c.record_grammar(build_grammar("I want to eat a pear"))
+        assert recording.digest != other.digest
+
+        # Recording with a rule cache should give the same result, and
+        #  cached rules should not be walked again.
+        walked_rules = []
+        compile_rule = c._compile_rule
+        def counting_compile_rule(rule, compiler):
+            walked_rules.append(rule)
+            compile_rule(rule, compiler)
+        c._compile_rule = counting_compile_rule
+
+        rule_cache = {}
+        cached = c.record_grammar(grammar, rule_cache)
+        assert list(rule_cache) == list(grammar.rules)
+        assert walked_rules == list(grammar.rules)
+        assert cached.digest == recording.digest
+        assert c.record_grammar(grammar, rule_cache).digest == cached.digest
+        assert walked_rules == list(grammar.rules)
+
+
 if __name__ == '__main__':
     unittest.main()